@@ -23,8 +23,12 @@ Options
     --font       Use precomputed Jungle Wars font offsets
 """
 from docopt import docopt
+import io
 from jw_memorymap import FONT_DATA_START, FONT_DATA_END
 
+# Lets the many small patch writes coalesce before hitting the disk
+ROM_BUFFER_SIZE = 1 << 20
+
 # python jw_patcher.py create roms\jw_patched.gb 0x1EF0B 0x1EFC5 patches\overworld_font.patch
 
 
@@ -190,23 +194,23 @@ if __name__ == '__main__':
 
         patch_path = arguments['<patchfile>']
 
-        rom = open(arguments["<romfile>"], 'rb+')
+        rom = io.BufferedRandom(open(arguments["<romfile>"], 'rb+', buffering=0), buffer_size=ROM_BUFFER_SIZE)
         apply_patch(rom, patch_path, offset)
         rom.close()
 
     elif arguments['apply_windows']:
 
-        rom = open(arguments["<romfile>"], 'rb+')
+        rom = io.BufferedRandom(open(arguments["<romfile>"], 'rb+', buffering=0), buffer_size=ROM_BUFFER_SIZE)
         insert_windows_code(rom)
         insert_windows_moved_routine(rom)
         rom.close()
 
     elif arguments['apply_enemies']:
-        rom = open(arguments["<romfile>"], 'rb+')
+        rom = io.BufferedRandom(open(arguments["<romfile>"], 'rb+', buffering=0), buffer_size=ROM_BUFFER_SIZE)
         insert_enemy_name_loading_redirection_code(rom)
         rom.close()
 
     elif arguments['apply_npcs']:
-        rom = open(arguments["<romfile>"], 'rb+')
+        rom = io.BufferedRandom(open(arguments["<romfile>"], 'rb+', buffering=0), buffer_size=ROM_BUFFER_SIZE)
         insert_npc_name_reading_code(rom)
         rom.close()
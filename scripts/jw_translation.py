@@ -1,11 +1,12 @@
 #!/usr/bin/python
 # -*- coding:utf-8 -*-
 """Usage: jw_translation.py insert [--no-backup] <romfile> <inputfile> <tablefile>
-          jw_translation.py merge <existing> <inputfile> [<outputfile>]
+          jw_translation.py merge [--pretty] <existing> <inputfile> [<outputfile>]
           jw_translation.py insert_windows [--no-backup] <romfile> <inputfile> <tablefile>
           jw_translation.py insert_enemies [--no-backup] <romfile> <inputfile> <tablefile>
           jw_translation.py insert_signs [--no-backup] <romfile> <inputfile> <tablefile>
           jw_translation.py insert_npcs [--no-backup] <romfile> <inputfile> <tablefile>
+          jw_translation.py batch [--no-backup] <jobsfile>
 
 
 Helping script for manipulating Jungle Wars text.
@@ -16,27 +17,49 @@ Arguments
     <tablefile>  Translation table to use
     <existing>   Existing YAML file in which to merge
     <outputfile> If specified save the merge there, if not, in place
+    <jobsfile>   YAML list of inserts to run in a row, each with the keys
+                 action (insert, insert_windows...), rom, input and table
 
 Options
     --no-backup  Disable the automatic backup before patching
+    --pretty     Format the merged YAML with pyaml (slower)
 """
 from docopt import docopt
 import os
+import re
+import sys
 from translation_table import TranslationTable
 import pyaml
 import yaml
+try:
+    from yaml import CSafeLoader as Loader, CSafeDumper as Dumper
+except ImportError:
+    from yaml import SafeLoader as Loader, SafeDumper as Dumper
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
 import shutil
+from struct import pack_into
 import datetime
+import errno
+import functools
 from jw_win import JWWindow
 from hexint import HexInt, hexint_representer
 from jw_memorymap import SIGNS_DATA_ALLOCATED_SPACE, ENNEMIES_DATA_ALLOCATED_SPACE, SIGNS_DATA_POINTERS_START
 
 
 pyaml.add_representer(HexInt, hexint_representer)
+Dumper.add_representer(HexInt, hexint_representer)
 
 
 MAX_LENGTH = 17
 
+# Linux ioctl cloning a whole file (btrfs, xfs...)
+FICLONE = 0x40049409
+
+OVERWORLD_TABLEFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../tbl/jw-py-en-overworld.tbl")
+
 
 # Encodes the actual length represented by "special bytes in text"
 SPECIAL_BYTES = {
@@ -59,10 +82,172 @@ SPECIAL_BYTES = {
     "<FC>": 1,            # FC
 }
 
+# Difference between the displayed length and the length of the token string
+_TOKEN_DELTA = {k: SPECIAL_BYTES[k] - len(k) for k in SPECIAL_BYTES}
+_TOKENS = tuple(sorted(SPECIAL_BYTES, key=len, reverse=True))
+# Matches any special byte in a single pass, longest tokens first, each in its own group.
+# The brackets are factored out so a match is only attempted from a '<', and the
+# alternatives are then tried on the name which follows.
+_TOKEN_RE = re.compile('<(?:' + '|'.join('(' + re.escape(k[1:-1]) + ')' for k in _TOKENS) + ')>')
+# Deltas indexed by the number of the group which matched, no need to hash the match
+_GROUP_DELTAS = (0,) + tuple(_TOKEN_DELTA[k] for k in _TOKENS)
+
+if ahocorasick is not None:
+    _TOKEN_AUTOMATON = ahocorasick.Automaton()
+    for token_str in SPECIAL_BYTES:
+        _TOKEN_AUTOMATON.add_word(token_str, _TOKEN_DELTA[token_str])
+    _TOKEN_AUTOMATON.make_automaton()
+
+    def special_bytes_delta(word):
+        """Returns how much longer (or shorter) word is displayed than its string length."""
+        return sum(delta for _, delta in _TOKEN_AUTOMATON.iter(word))
+
+else:
+    def special_bytes_delta(word):
+        """Returns how much longer (or shorter) word is displayed than its string length."""
+        return sum(_GROUP_DELTAS[m.lastindex] for m in _TOKEN_RE.finditer(word))
+
+
+def break_lines(widths, max_length):
+    """ Returns the indices of the words starting a new line.
+
+    Uses as few lines as possible, and among those the breaks minimizing the
+    sum of the squared space left at the end of each line but the last one,
+    so the lines come out even instead of a full line followed by a short one.
+    A word longer than max_length gets a line of its own.
+    """
+
+    n = len(widths)
+    if sum(widths) + n - 1 <= max_length:
+        return []
+
+    # For the first i words: line count, cost and start of the last line
+    line_counts = [0] * (n + 1)
+    costs = [0] * (n + 1)
+    previous = [0] * (n + 1)
+    for i in range(1, n + 1):
+        not_last = i < n
+        best_count = best_cost = best_start = -1
+        line_width = -1
+        for j in range(i - 1, -1, -1):
+            line_width += widths[j] + 1
+            if line_width > max_length and j < i - 1:
+                break
+            cost = costs[j]
+            if not_last and line_width < max_length:
+                slack = max_length - line_width
+                cost += slack * slack
+            count = line_counts[j] + 1
+            if best_start < 0 or count < best_count or (count == best_count and cost < best_cost):
+                best_count = count
+                best_cost = cost
+                best_start = j
+        line_counts[i] = best_count
+        costs[i] = best_cost
+        previous[i] = best_start
+
+    starts = []
+    i = n
+    while i > 0:
+        i = previous[i]
+        starts.append(i)
+    starts.reverse()
+    return starts[1:]
+
+
+# Displayed width of the words containing tags, starting with the tags alone
+_TAG_WORD_WIDTHS = dict(SPECIAL_BYTES)
+
+
+def tag_word_width(word):
+    """Returns the displayed width of a word containing tags, only scanned once per word."""
+    width = _TAG_WORD_WIDTHS.get(word)
+    if width is None:
+        width = _TAG_WORD_WIDTHS[word] = len(word) + special_bytes_delta(word)
+    return width
+
+
+def tokenize(text):
+    """ Splits text into paragraphs (separated by <br>) of words.
+
+    Returns a list of (words, widths) tuples, the widths being the length of
+    each word as displayed. Only words containing a tag need to be scanned
+    for special bytes.
+    """
+
+    # Bound locally, these are looked up for every word
+    word_width = tag_word_width
+    _len = len
+
+    paragraphs = []
+    # No need to strip the lines, split() ignores the surrounding whitespace
+    for line in text.split("<br>"):
+        words = line.split()
+        widths = [word_width(word) if "<" in word else _len(word) for word in words]
+        paragraphs.append((words, widths))
+    return paragraphs
+
+
+# Line break inside a text box, and the one moving on to the next box
+BREAK_BYTES = ("<FE>", "<FD>")
+# Bytes ending a message, <FF> is added if the text does not end with one
+TERMINATORS = ("<FF>", "<FC>")
+
+
+@functools.lru_cache(maxsize=4096)
+def wrap_text(text, max_length):
+    """ Wraps text to fit lines of max_length characters in 2-line text boxes.
+
+    Returns the wrapped text, with <FE>/<FD> line breaks and the final <FF>,
+    and its length as displayed. The result only depends on the arguments, so
+    it is cached for texts prepared several times.
+    """
+
+    # Short plain text, already fitting on a single line
+    if len(text) <= max_length and "<" not in text and " ".join(text.split()) == text:
+        return text + "<FF>", len(text) + 1
+
+    paragraphs = tokenize(text)
+
+    # Bound locally, these are looked up for every line
+    break_bytes = BREAK_BYTES
+    join = " ".join
+
+    parts = []
+    append = parts.append
+    length = 0
+    line_num = 0
+    last_line = len(paragraphs) - 1
+    for line in range(len(paragraphs)):
+        words, widths = paragraphs[line]
+        # Words, one byte between each of them (space or line break) and one at the end
+        length += sum(widths) + max(len(words), 1)
+        if words:
+            starts = [0] + break_lines(widths, max_length)
+            ends = starts[1:] + [len(words)]
+            append(join(words[0:ends[0]]))
+            for start, end in zip(starts[1:], ends[1:]):
+                append(break_bytes[line_num & 1])
+                line_num += 1
+                append(join(words[start:end]))
+
+        if line < last_line:
+            append(break_bytes[line_num & 1])
+        else:
+            if not parts or not parts[-1].endswith(TERMINATORS):
+                append("<FF>")
+        line_num += 1
+
+    return "".join(parts), length
+
 
 class TextString:
 
-    def __init__(self, pointer_address, text, max_length=MAX_LENGTH):
+    # One per message is kept until the pointers are written, no __dict__ needed
+    __slots__ = ("pointer_address", "text", "new_bank", "new_pointer", "binary_text",
+                 "length", "max_length", "overworld", "additional_pointers")
+
+    def __init__(self, pointer_address, text, max_length=MAX_LENGTH, overworld=False, additional_pointers=None):
 
         self.pointer_address = pointer_address
         self.text = text
@@ -71,8 +256,8 @@ class TextString:
         self.binary_text = None
         self.length = 0
         self.max_length = max_length
-        self.overworld = False
-        self.additional_pointers = []
+        self.overworld = overworld
+        self.additional_pointers = additional_pointers if additional_pointers is not None else []
 
     def prepare(self):
         """ Returns the text, ready to be written in the ROM.
@@ -83,61 +268,90 @@ class TextString:
         <F4> is 8 characters
         """
 
-        words = self.text.split()
-        lines = [line.strip() for line in self.text.split("<br>")]
-
-        prepared_text = ""
-        self.length = 0
-        line_num = 0
-        for line in range(len(lines)):
-            words = lines[line].split()
-            cur_line_length = 0
-            for i in range(len(words)):
-                word = words[i]
-                word_length = len(word)
-
-                for b in SPECIAL_BYTES:
-                    if word.find(b) != -1:
-                        word_length -= len(b)
-                        word_length += SPECIAL_BYTES[b]
-
-                if i == 0:
-                    prepared_text += word
-                    self.length += word_length
-                    cur_line_length += word_length
-
-                else:
-                    if cur_line_length + 1 + word_length <= self.max_length:
-                        prepared_text += " " + word
-                        self.length += word_length + 1
-                        cur_line_length += word_length + 1
-                    else:
-                        if line_num % 2 == 0:
-                            prepared_text += "<FE>"
-                        else:
-                            prepared_text += "<FD>"
-                        line_num += 1
-                        self.length += 1
-                        cur_line_length = 0
-
-                        prepared_text += word
-                        self.length += word_length
-                        cur_line_length += word_length
-
-            if line < len(lines) - 1:
-                if line_num % 2 == 0:
-                    prepared_text += "<FE>"
-                else:
-                    prepared_text += "<FD>"
-            else:
-                if prepared_text[-4:] not in ['<FF>', '<FC>']:
-                    prepared_text += "<FF>"
-            self.length += 1
-            line_num += 1
-            cur_line_length = 0
+        prepared_text, self.length = wrap_text(self.text, self.max_length)
         # print(prepared_text)
         return prepared_text
 
+    @classmethod
+    def prepare_many(cls, inputs):
+        """ Returns the (prepared text, length) of each (text, max_length) pair.
+
+        Same result as calling prepare() on a TextString built for each pair,
+        without creating the objects.
+        """
+
+        return [wrap_text(text, max_length) for text, max_length in inputs]
+
+
+@functools.cache
+def get_overworld_table():
+    """Returns the overworld translation table, only parsed on first use."""
+    return TranslationTable(OVERWORLD_TABLEFILE)
+
+
+def fast_backup(src, dst):
+    """Copies src to dst, as a copy-on-write clone when the filesystem supports it.
+
+    Never overwrites dst, raises FileExistsError if it already exists.
+    """
+    if os.path.exists(dst):
+        raise FileExistsError(errno.EEXIST, "Backup file already exists", dst)
+
+    if sys.platform == "darwin":
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.clonefile(os.fsencode(src), os.fsencode(dst), 0) == 0:
+            return
+    elif sys.platform.startswith("linux"):
+        import fcntl
+        with open(src, 'rb') as src_file, open(dst, 'xb') as dst_file:
+            try:
+                fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+                cloned = True
+            except OSError:
+                cloned = False
+        if cloned:
+            shutil.copymode(src, dst)
+            return
+
+    # Overwrites at most the empty file left by a failed clone above
+    shutil.copy(src, dst)
+
+
+def backup_rom(rom_path):
+    """Backs up the rom file in case..., returns the path of the backup."""
+    now = datetime.datetime.now().strftime(format="%Y%m%d_%H_%M_%S")
+    backup_path = rom_path + ".backup." + now
+    # Several backups of the same rom can happen within a second
+    suffix = 1
+    while os.path.exists(backup_path):
+        backup_path = rom_path + ".backup." + now + "." + str(suffix)
+        suffix += 1
+    fast_backup(rom_path, backup_path)
+    return backup_path
+
+
+def read_rom(rom_file):
+    """Returns an in-memory copy of the whole ROM, to be patched with put()."""
+    rom_file.seek(0)
+    return bytearray(rom_file.read())
+
+
+def write_rom(rom_file, buf):
+    """Writes back the whole patched ROM in one go."""
+    rom_file.seek(0)
+    rom_file.write(buf)
+
+
+def put(buf, offset, data):
+    """Writes data at offset in the ROM buffer, returns the offset right after it."""
+    if offset > len(buf):
+        # Same as seeking past the end of the file before writing
+        buf.extend(bytes(offset - len(buf)))
+    end = offset + len(data)
+    buf[offset:end] = data
+    return end
+
 
 def insert_translation(rom_file, translation_data, table):
 
@@ -145,28 +359,27 @@ def insert_translation(rom_file, translation_data, table):
     combat = translation_data["combat"]
     combat_wide = translation_data["combat_wide"]
     in_place = translation_data.get("in_place", {})
-    OVERWORLD_TABLEFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../tbl/jw-py-en-overworld.tbl")
-    overworld_table = TranslationTable(OVERWORLD_TABLEFILE)
 
     messages = [TextString(0x1A581, "A morning in the Jungle.<FC>")]
 
-    for msg_set in [(script, 17), (combat, 10), (combat_wide, 17)]:
-        msg_len = msg_set[1]
-        for m in msg_set[0].values():
-            if m["translation"][0:4] != 'TODO' and m['pointer_location'] != 0:
-                ts = TextString(m['pointer_location'],
-                                m['translation'],
-                                max_length=msg_len)
-                if m.get('overworld', False):
-                    ts.overworld = True
-                ts.additional_pointers = m.get('additional_pointers', [])
-                messages.append(ts)
+    for msg_set, msg_len in ((script, 17), (combat, 10), (combat_wide, 17)):
+        messages.extend(TextString(m['pointer_location'],
+                                   m['translation'],
+                                   max_length=msg_len,
+                                   overworld=m.get('overworld', False),
+                                   additional_pointers=m.get('additional_pointers'))
+                        for m in msg_set.values()
+                        if not m['translation'].startswith('TODO') and m['pointer_location'] != 0)
+
+    rom_data = read_rom(rom_file)
 
     for m in in_place:
         offset = m
         message_bytes = table.convert_script(in_place[m]["translation"])
-        rom_file.seek(offset)
-        rom_file.write(message_bytes)
+        put(rom_data, offset, message_bytes)
+
+    # Bank (1 byte) and pointer (2 bytes) of each message
+    pointer_table = bytearray(len(messages) * 3)
 
     message_index = 0
     total_length = 0
@@ -175,7 +388,7 @@ def insert_translation(rom_file, translation_data, table):
     for m in messages:
         if m.overworld:
             print("Overworld message!")
-            m.binary_text = overworld_table.convert_script(m.prepare())
+            m.binary_text = get_overworld_table().convert_script(m.prepare())
         else:
             m.binary_text = table.convert_script(m.prepare())
 
@@ -190,19 +403,17 @@ def insert_translation(rom_file, translation_data, table):
             m.new_pointer = 0
             total_length = m.length
 
-        rom_file.seek(m.pointer_address)
-        rom_file.write((message_index * 3).to_bytes(2, "little"))
+        pack_into('<H', rom_data, m.pointer_address, message_index * 3)
         for p in m.additional_pointers:
-            rom_file.seek(p)
-            rom_file.write((message_index * 3).to_bytes(2, "little"))  
-        rom_file.seek(0x10 * 0x4000 + 0x1000 + message_index * 0x03)
-        rom_file.write((m.new_bank).to_bytes(1, "little"))
-        rom_file.write((m.new_pointer).to_bytes(2, "little"))
-
-        rom_file.seek(m.new_bank * 0x4000 + m.new_pointer)
-        rom_file.write(m.binary_text)
+            pack_into('<H', rom_data, p, message_index * 3)
+        pack_into('<BH', pointer_table, message_index * 3, m.new_bank, m.new_pointer)
+
+        put(rom_data, m.new_bank * 0x4000 + m.new_pointer, m.binary_text)
         message_index += 1
 
+    put(rom_data, 0x10 * 0x4000 + 0x1000, pointer_table)
+    write_rom(rom_file, rom_data)
+
     print("Wrote up to bank " + hex(data_bank))
 
 
@@ -212,8 +423,9 @@ def insert_windows(rom_file, windows_data, table):
     POINTERS_START_OVERLAY = 0x1F * 0x4000 + 0x500
     DATA_START = 0x1F * 0x4000 + 0x1000
 
-    OVERWORLD_TABLEFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../tbl/jw-py-en-overworld.tbl")
-    overworld_table = TranslationTable(OVERWORLD_TABLEFILE)
+    overworld_table = get_overworld_table()
+
+    rom_data = read_rom(rom_file)
 
     total_size = 0
 
@@ -221,14 +433,13 @@ def insert_windows(rom_file, windows_data, table):
         data = windows_data["fullscreen"][win_id]
         win = JWWindow()
         win.from_yaml(data, win_id)
-        rom_file.seek(POINTERS_START_FULLSCREEN + win.id * 2)
-        rom.write((0x5000 + total_size).to_bytes(2, "little"))
-        rom.seek(DATA_START + total_size)
+        pack_into('<H', rom_data, POINTERS_START_FULLSCREEN + win.id * 2, 0x5000 + total_size)
+        offset = DATA_START + total_size
         force_header = data.get("force_header", None)
         if force_header:
-            rom.write(force_header.to_bytes(6, "big"))
+            offset = put(rom_data, offset, force_header.to_bytes(6, "big"))
         else:
-            rom.write(win.recompute_header())
+            offset = put(rom_data, offset, win.recompute_header())
         total_size += 6
         translation = None
         if data.get("overworld", False):
@@ -236,21 +447,20 @@ def insert_windows(rom_file, windows_data, table):
             translation = overworld_table.convert_script(win.translation)
         else:
             translation = table.convert_script(win.translation)
-        rom.write(translation)
+        put(rom_data, offset, translation)
         total_size += len(translation)
 
     for win_id in windows_data["overlay"]:
         data = windows_data["overlay"][win_id]
         win = JWWindow()
         win.from_yaml(data, win_id)
-        rom_file.seek(POINTERS_START_OVERLAY + (win.id - 0x80) * 2)
-        rom.write((0x5000 + total_size).to_bytes(2, "little"))
-        rom.seek(DATA_START + total_size)
+        pack_into('<H', rom_data, POINTERS_START_OVERLAY + (win.id - 0x80) * 2, 0x5000 + total_size)
+        offset = DATA_START + total_size
         force_header = data.get("force_header", None)
         if force_header:
-            rom.write(force_header.to_bytes(6, "big"))
+            offset = put(rom_data, offset, force_header.to_bytes(6, "big"))
         else:
-            rom.write(win.recompute_header())
+            offset = put(rom_data, offset, win.recompute_header())
         total_size += 6
         translation = None
         if data.get("overworld", False):
@@ -258,15 +468,19 @@ def insert_windows(rom_file, windows_data, table):
             translation = overworld_table.convert_script(win.translation)
         else:
             translation = table.convert_script(win.translation)
-        rom.write(translation)
+        put(rom_data, offset, translation)
         total_size += len(translation)
 
+    write_rom(rom_file, rom_data)
+
 def insert_enemies(rom_file, enemies_data, table):
 
     POINTERS_START = 0x0C * 0x4000
 
     DATA_RANGES = ENNEMIES_DATA_ALLOCATED_SPACE
 
+    rom_data = read_rom(rom_file)
+
     total_size = 0
     current_data_range = 0
     base_offset = DATA_RANGES[0][0]
@@ -288,15 +502,15 @@ def insert_enemies(rom_file, enemies_data, table):
 
         pointer_value = base_offset - (0xC - 1) * 0x4000 + total_size
 
-        rom_file.seek(pointer_location)
-        rom.write((pointer_value).to_bytes(2, "little"))
+        pack_into('<H', rom_data, pointer_location, pointer_value)
 
-        rom.seek(base_offset + total_size)
-        rom.write(data["original_header"].to_bytes(22, "big"))
-        rom.write(translation)
+        offset = put(rom_data, base_offset + total_size, data["original_header"].to_bytes(22, "big"))
+        put(rom_data, offset, translation)
 
         total_size += data_size
 
+    write_rom(rom_file, rom_data)
+
 
 def insert_signs(rom_file, signs_data, table):
 
@@ -304,6 +518,8 @@ def insert_signs(rom_file, signs_data, table):
 
     DATA_RANGES = SIGNS_DATA_ALLOCATED_SPACE
 
+    rom_data = read_rom(rom_file)
+
     total_size = 0
     current_data_range = 0
     base_offset = DATA_RANGES[0][0]
@@ -326,157 +542,136 @@ def insert_signs(rom_file, signs_data, table):
             total_size = 0
 
         pointer_value = base_offset - (0xC - 1) * 0x4000 + total_size
-        rom_file.seek(pointer_location)
-        rom.write((pointer_value).to_bytes(2, 'little'))
+        pack_into('<H', rom_data, pointer_location, pointer_value)
 
-        rom.seek(base_offset + total_size)
+        offset = base_offset + total_size
         for translation in translations:
-            rom.write(len(translation).to_bytes(1, 'big'))
-            rom.write(translation)
+            offset = put(rom_data, offset, len(translation).to_bytes(1, 'big'))
+            offset = put(rom_data, offset, translation)
 
         total_size += data_size
 
+    write_rom(rom_file, rom_data)
+
 def insert_npcs(rom_file, npc_data, table):
 
+    rom_data = read_rom(rom_file)
+
     for id in npc_data["npcs"]:
         data = npc_data["npcs"][id]
 
         translation = table.convert_script(data['name_translated'])
 
-        rom_file.seek(data['location'] + (0x1C - 0x0D) * 0x4000)
-
-        rom.write(translation)
-        rom.write(b'\xFF')
-
-
-if __name__ == '__main__':
-    arguments = docopt(__doc__, version='1.0')
-
-    if arguments["insert"]:
+        offset = put(rom_data, data['location'] + (0x1C - 0x0D) * 0x4000, translation)
+        put(rom_data, offset, b'\xFF')
 
-        table = TranslationTable(arguments['<tablefile>'])
+    write_rom(rom_file, rom_data)
 
-        if not arguments["--no-backup"]:
-            # Make a backup of the rom file in case...
-            now = datetime.datetime.now().strftime(format="%Y%m%d_%H_%M_%S")
-            shutil.copy(arguments["<romfile>"], arguments["<romfile>"] + ".backup." + now)
 
-        rom = open(arguments["<romfile>"], 'rb+')
-
-        translation_file = open(arguments["<inputfile>"], encoding='utf-8')
-        data = yaml.load(translation_file, Loader=yaml.FullLoader)
-        translation_file.close()
-
-        insert_translation(rom, data, table)
-
-        rom.close()
-
-    elif arguments["insert_windows"]:
-
-        table = TranslationTable(arguments['<tablefile>'])
-
-        if not arguments["--no-backup"]:
-            # Make a backup of the rom file in case...
-            now = datetime.datetime.now().strftime(format="%Y%m%d_%H_%M_%S")
-            shutil.copy(arguments["<romfile>"], arguments["<romfile>"] + ".backup." + now)
-
-        rom = open(arguments["<romfile>"], 'rb+')
-
-        translation_file = open(arguments["<inputfile>"], encoding='utf-8')
-        data = yaml.load(translation_file, Loader=yaml.FullLoader)
-        translation_file.close()
-
-        insert_windows(rom, data, table)
-
-        rom.close()
-
-    elif arguments["insert_enemies"]:
+# Insert subcommands and the function doing the job
+INSERT_COMMANDS = {
+    "insert": insert_translation,
+    "insert_windows": insert_windows,
+    "insert_enemies": insert_enemies,
+    "insert_signs": insert_signs,
+    "insert_npcs": insert_npcs,
+}
 
-        table = TranslationTable(arguments['<tablefile>'])
 
-        if not arguments["--no-backup"]:
-            # Make a backup of the rom file in case...
-            now = datetime.datetime.now().strftime(format="%Y%m%d_%H_%M_%S")
-            shutil.copy(arguments["<romfile>"], arguments["<romfile>"] + ".backup." + now)
+@functools.cache
+def get_table(table_path):
+    """Returns the translation table, only parsed once per path."""
+    return TranslationTable(table_path)
 
-        rom = open(arguments["<romfile>"], 'rb+')
 
-        translation_file = open(arguments["<inputfile>"], encoding='utf-8')
-        data = yaml.load(translation_file, Loader=yaml.FullLoader)
-        translation_file.close()
+@functools.cache
+def load_translation(input_path):
+    """Returns the translation data, only parsed once per path."""
+    translation_file = open(input_path, encoding='utf-8')
+    data = yaml.load(translation_file, Loader=Loader)
+    translation_file.close()
+    return data
 
-        insert_enemies(rom, data, table)
 
-        rom.close()
+def run_insert(insert_function, rom_path, input_path, table_path, backup=True):
+    """Inserts the translation from the YAML file input_path in the ROM."""
 
-    elif arguments["insert_signs"]:
+    table = get_table(table_path)
 
-        table = TranslationTable(arguments['<tablefile>'])
+    if backup:
+        backup_rom(rom_path)
 
-        if not arguments["--no-backup"]:
-            # Make a backup of the rom file in case...
-            now = datetime.datetime.now().strftime(format="%Y%m%d_%H_%M_%S")
-            shutil.copy(arguments["<romfile>"], arguments["<romfile>"] + ".backup." + now)
+    rom_file = open(rom_path, 'rb+')
 
-        rom = open(arguments["<romfile>"], 'rb+')
+    data = load_translation(input_path)
 
-        translation_file = open(arguments["<inputfile>"], encoding='utf-8')
-        data = yaml.load(translation_file, Loader=yaml.FullLoader)
-        translation_file.close()
+    insert_function(rom_file, data, table)
 
-        insert_signs(rom, data, table)
+    rom_file.close()
 
-        rom.close()
 
-    elif arguments["insert_npcs"]:
+if __name__ == '__main__':
+    arguments = docopt(__doc__, version='1.0')
 
-        table = TranslationTable(arguments['<tablefile>'])
+    insert_command = next((command for command in INSERT_COMMANDS if arguments[command]), None)
 
-        if not arguments["--no-backup"]:
-            # Make a backup of the rom file in case...
-            now = datetime.datetime.now().strftime(format="%Y%m%d_%H_%M_%S")
-            shutil.copy(arguments["<romfile>"], arguments["<romfile>"] + ".backup." + now)
+    if insert_command:
 
-        rom = open(arguments["<romfile>"], 'rb+')
+        run_insert(INSERT_COMMANDS[insert_command],
+                   arguments["<romfile>"],
+                   arguments["<inputfile>"],
+                   arguments["<tablefile>"],
+                   backup=not arguments["--no-backup"])
 
-        translation_file = open(arguments["<inputfile>"], encoding='utf-8')
-        data = yaml.load(translation_file, Loader=yaml.FullLoader)
-        translation_file.close()
+    elif arguments["batch"]:
 
-        insert_npcs(rom, data, table)
+        # Tables and translations shared by several jobs are only loaded once
+        jobs_file = open(arguments["<jobsfile>"], encoding='utf-8')
+        jobs = yaml.load(jobs_file, Loader=Loader)
+        jobs_file.close()
 
-        rom.close()
+        # Each rom is backed up once, before its first job patches it
+        backed_up = set()
+        for job in jobs:
+            print(job["action"] + " " + job["input"] + " -> " + job["rom"])
+            if not arguments["--no-backup"] and job["rom"] not in backed_up:
+                backup_rom(job["rom"])
+                backed_up.add(job["rom"])
+            run_insert(INSERT_COMMANDS[job["action"]],
+                       job["rom"],
+                       job["input"],
+                       job["table"],
+                       backup=False)
 
     elif arguments["merge"]:
 
-        # jw_translation.py merge <existing> <inputfile> [<outputfile>]
+        # jw_translation.py merge [--pretty] <existing> <inputfile> [<outputfile>]
 
         file1 = open(arguments["<existing>"], encoding='utf-8')
-        data_existing = yaml.load(file1, Loader=yaml.FullLoader)
+        data_existing = yaml.load(file1, Loader=Loader)
         file1.close()
 
         file2 = open(arguments["<inputfile>"], encoding='utf-8')
-        data_new = yaml.load(file2, Loader=yaml.FullLoader)
+        data_new = yaml.load(file2, Loader=Loader)
         file2.close()
 
+        # Section of each existing location, the first one wins if duplicated
+        loc_index = {}
+        for section1 in data_existing:
+            for loc1 in data_existing[section1]:
+                loc_index.setdefault(loc1, section1)
+
         for section2 in data_new:
             for loc2 in data_new[section2]:
-                found = False
-                found_element = None
-                found_section = None
-                for section1 in data_existing:
-                    if loc2 in data_existing[section1]:
-                        found = True
-                        # found_element = data_existing[section1][loc2]
-                        found_section = section1
-                        break
+                section1 = loc_index.get(loc2)
+                found = section1 is not None
 
                 if found:
 
                     element1 = data_existing[section1][loc2]
                     element2 = data_new[section2][loc2]
 
-                    if data_existing[section1][loc2] != data_new[section2][loc2]:
+                    if element1 != element2:
                         if (section1 == "script"
                                 and element1["translation"][0:4] == "TODO"
                                 and element1["pointer_location"] == 0):
@@ -524,6 +719,7 @@ if __name__ == '__main__':
                     if "script" not in data_existing:
                         data_existing["script"] = {}
                     data_existing["script"][loc2] = data_new[section2][loc2]
+                    loc_index[loc2] = "script"
 
         outfile = None
         if arguments["<outputfile>"]:
@@ -531,5 +727,10 @@ if __name__ == '__main__':
         else:
             outfile = open(arguments['<existing>'], 'w', encoding='utf-8')
 
-        outfile.write(pyaml.dump(data_existing, indent=2, vspacing=[2, 1], width=float("inf")))
+        if arguments["--pretty"]:
+            outfile.write(pyaml.dump(data_existing, indent=2, vspacing=[2, 1], width=float("inf")))
+        else:
+            # Streamed to the file, the C emitter does not accept an infinite width
+            yaml.dump(data_existing, outfile, Dumper=Dumper, default_flow_style=False,
+                      allow_unicode=True, indent=2, width=1 << 30)
         outfile.close()
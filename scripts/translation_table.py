@@ -14,6 +14,8 @@ class TranslationTable(object):
     def __init__(self, filename):
         self.table = {}
         self.inverse_table = {}
+        # Scripts often repeat the same short strings, keep their conversion
+        self.script_cache = {}
 
         f = open(filename, 'r', encoding="utf8")
         for line in f:
@@ -31,18 +33,20 @@ class TranslationTable(object):
             return str(b)
 
     def convert_bytearray(self, ba):
-        result = ""
-        for b in ba:
-            result += self.convert_byte(b)
-        return result
+        return "".join([self.convert_byte(b) for b in ba])
 
     def convert_script(self, script):
-        result = b''
+        if script in self.script_cache:
+            return self.script_cache[script]
+
+        result = bytearray()
         token = ''
         for character in script:
             token += character
             if token in self.inverse_table:
                 # print(token)
-                result += bytes([self.inverse_table[token]])
+                result.append(self.inverse_table[token])
                 token = ''
+        result = bytes(result)
+        self.script_cache[script] = result
         return result